@@ -1,27 +1,23 @@
 # app.py
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from ytmusicapi import YTMusic
-import shutil
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache
+import requests
+import orjson
+import asyncio
+import functools
+import hashlib
+import tempfile
 import os
 import logging
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("AureumAPI")
 
-app = FastAPI(title="Aureum Music API (Stable Version)")
-
-# ---------------------------------------------------
-# CORS
-# ---------------------------------------------------
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # ---------------------------------------------------
 # COOKIE HANDLING (Supports Render + Vercel)
 # ---------------------------------------------------
@@ -31,6 +27,18 @@ WRITABLE = "/tmp/cookies.txt"               # Writeable for yt-dlp
 COOKIES_ENV = os.getenv("YT_COOKIES")       # Vercel env var
 
 
+def write_cookies(data):
+    """Atomically replace WRITABLE so other workers never read a partial file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(WRITABLE), prefix=".cookies-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp, WRITABLE)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
 def load_cookies():
     """
     Checks in this order:
@@ -42,21 +50,21 @@ def load_cookies():
     # CASE 1 — Vercel environment variable
     if COOKIES_ENV:
         try:
-            with open(WRITABLE, "w") as f:
-                f.write(COOKIES_ENV)
+            write_cookies(COOKIES_ENV)
             log.info("Loaded cookies from ENV → /tmp/cookies.txt")
             return WRITABLE
         except Exception as e:
-            log.error(f"Failed writing ENV cookies: {e}")
+            log.error("Failed writing ENV cookies: %s", e)
 
     # CASE 2 — Render read-only secret
     if os.path.exists(READONLY):
         try:
-            shutil.copy(READONLY, WRITABLE)
+            with open(READONLY) as f:
+                write_cookies(f.read())
             log.info("Copied /etc/secrets/cookies.txt → /tmp/cookies.txt")
             return WRITABLE
         except Exception as e:
-            log.error(f"Failed copying cookies: {e}")
+            log.error("Failed copying cookies: %s", e)
 
     # CASE 3 — Already exists
     if os.path.exists(WRITABLE):
@@ -68,7 +76,23 @@ def load_cookies():
     return None
 
 
-cookie_path = load_cookies()
+cookie_path = None  # set by startup()
+
+# ---------------------------------------------------
+# HTTP SESSION (shared keep-alive pool for YTMusic)
+# ---------------------------------------------------
+
+def make_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Same default ytmusicapi applies to its own session; never hang forever
+    session.request = functools.partial(session.request, timeout=30)
+    return session
+
+
+http_session = make_session()
 
 # ---------------------------------------------------
 # YTMUSIC INITIALIZATION
@@ -78,92 +102,240 @@ def init_ytmusic():
     # Try cookie authentication
     try:
         if cookie_path:
-            ytm = YTMusic(auth=cookie_path)
+            ytm = YTMusic(auth=cookie_path, requests_session=http_session)
             log.info("YTMusic authenticated with cookies (OK)")
             return ytm
     except Exception as e:
-        log.error(f"YTMusic cookie auth failed: {e}")
+        log.error("YTMusic cookie auth failed: %s", e)
 
     # Fallback: unauthenticated
     try:
-        ytm = YTMusic()
+        ytm = YTMusic(requests_session=http_session)
         log.info("YTMusic initialized without cookies (Fallback)")
         return ytm
     except Exception as e:
-        log.error(f"YTMusic initialization failed completely: {e}")
+        log.error("YTMusic initialization failed completely: %s", e)
         return None
 
 
-ytm = init_ytmusic()
+ytm = None  # set by startup()
+
+# ---------------------------------------------------
+# STARTUP (background init so the server binds immediately)
+# ---------------------------------------------------
+
+async def startup():
+    global cookie_path, ytm, ROOT_BODY, HEALTH_BODY
+
+    cookie_path = await asyncio.to_thread(load_cookies)
+    ytm = await asyncio.to_thread(init_ytmusic)
+    ROOT_BODY = root_body()
+    HEALTH_BODY = health_body()
+
+    # Open the TLS connection now so the first real search doesn't pay it
+    if ytm:
+        try:
+            await asyncio.to_thread(ytm.search, "warm", filter="songs", limit=1)
+        except Exception as e:
+            log.warning("YTMusic warmup failed: %s", e)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Default pool is min(32, cpus + 4) threads, which on small instances is
+    # below the search cap; size it so SEARCH_SLOTS binds first and the
+    # startup/warmup calls still have headroom
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=SEARCH_CONCURRENCY + 4)
+    )
+
+    # Don't await: /health must answer while YTMusic is still initializing
+    init = asyncio.create_task(startup())
+    yield
+    init.cancel()
+    http_session.close()
+
+
+app = FastAPI(
+    title="Aureum Music API (Stable Version)",
+    lifespan=lifespan,
+)
+
+# ---------------------------------------------------
+# CORS
+# ---------------------------------------------------
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 # ---------------------------------------------------
 # ROOT
 # ---------------------------------------------------
-@app.get("/")
-def root():
-    return {
+# State only changes once startup() finishes, so serialize the body then
+def root_body():
+    return orjson.dumps({
         "status": "online",
         "cookies_loaded": cookie_path is not None,
         "ytmusic_ready": ytm is not None,
         "cookies_path": cookie_path,
         "message": "Use /search and play with Hidden YouTube Player."
-    }
+    })
+
+
+ROOT_BODY = root_body()
+
+
+@app.get("/")
+async def root():
+    return Response(ROOT_BODY, media_type="application/json")
+
+# ---------------------------------------------------
+# HELPERS
+# ---------------------------------------------------
+
+@functools.lru_cache(maxsize=4096)
+def _dur_to_sec(dur: str) -> int:
+    """Convert "SS" / "M:SS" / "H:MM:SS" to seconds (0 if missing)."""
+    if not dur:
+        return 0
+    return functools.reduce(lambda acc, part: acc * 60 + int(part), dur.split(":"), 0)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison per RFC 9110: W/"x" matches "x"."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(t.strip().removeprefix("W/") == etag for t in header.split(","))
+
 
 # ---------------------------------------------------
 # SEARCH ENDPOINT (Stable)
 # ---------------------------------------------------
+SEARCH_CACHE_CONTROL = "public, max-age=300, s-maxage=3600"
+
+# (json body, etag) keyed by (normalized query, limit)
+SEARCH_CACHE = TTLCache(maxsize=1024, ttl=600)
+
+# Cap in-flight YTMusic calls below the executor size set in lifespan(),
+# so spikes queue here instead of exhausting the thread pool
+SEARCH_CONCURRENCY = 16
+SEARCH_SLOTS = asyncio.Semaphore(SEARCH_CONCURRENCY)
+
+
+# Cache misses currently being fetched, so identical concurrent
+# searches share one YTMusic round-trip
+SEARCH_INFLIGHT = {}
+
+# Longest a client waits on a shared fetch. The fetch itself is left to
+# finish (bounded by the 30s session timeout) so its slot stays held.
+SEARCH_TIMEOUT = 45
+
+
+def _search_done(cache_key, task):
+    SEARCH_INFLIGHT.pop(cache_key, None)
+    # Mark the exception retrieved even if every waiter has disconnected
+    if not task.cancelled():
+        task.exception()
+
+
+async def fetch_search(cache_key, q: str, limit: int):
+    # ytmusicapi is blocking (requests); keep the event loop free
+    async with SEARCH_SLOTS:
+        results = await asyncio.to_thread(ytm.search, q, filter="songs", limit=limit)
+    out = []
+    append = out.append
+
+    for r in results:
+        if "videoId" not in r:
+            continue
+        get = r.get
+
+        # parse duration safely
+        dur = get("duration", "0:00")
+        sec = _dur_to_sec(dur)
+
+        thumbs = get("thumbnails")
+        thumb = thumbs[-1]["url"] if thumbs else ""
+
+        artists = get("artists")
+        names = filter(None, (a.get("name") for a in artists)) if artists else ()
+
+        append({
+            "videoId": r["videoId"],
+            "title": get("title", ""),
+            "artists": ", ".join(names),
+            "thumbnail": thumb,
+            "duration": dur,
+            "duration_seconds": sec
+        })
+
+    # Cache the encoded body with a content ETag so hits skip serialization
+    body = orjson.dumps(out)
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    entry = SEARCH_CACHE[cache_key] = (body, etag)
+    return entry
+
+
 @app.get("/search")
-async def search(q: str, limit: int = 20):
+async def search(request: Request, q: str, limit: int = 20):
     if not q.strip():
         raise HTTPException(400, "Missing ?q")
 
     if not ytm:
         raise HTTPException(503, "YTMusic unavailable")
 
-    try:
-        results = ytm.search(q, filter="songs", limit=limit)
-        out = []
-
-        for r in results:
-            if "videoId" not in r:
-                continue
-
-            # parse duration safely
-            dur = r.get("duration", "0:00")
-            sec = 0
-            if ":" in dur:
-                parts = list(map(int, dur.split(":")))
-                if len(parts) == 2:
-                    sec = parts[0] * 60 + parts[1]
-                elif len(parts) == 3:
-                    sec = parts[0] * 3600 + parts[1] * 60 + parts[2]
-
-            thumbs = r.get("thumbnails", [])
-            thumb = thumbs[-1]["url"] if thumbs else ""
-
-            out.append({
-                "videoId": r["videoId"],
-                "title": r.get("title", ""),
-                "artists": ", ".join(a["name"] for a in r.get("artists", [])),
-                "thumbnail": thumb,
-                "duration": dur,
-                "duration_seconds": sec
-            })
-
-        return out
+    cache_key = (q.strip().casefold(), limit)
+    entry = SEARCH_CACHE.get(cache_key)
 
-    except Exception as e:
-        log.error("SEARCH ERROR: %s", e)
-        raise HTTPException(500, f"Search failed: {e}")
+    if entry is None:
+        try:
+            task = SEARCH_INFLIGHT.get(cache_key)
+            if task is None:
+                task = asyncio.create_task(fetch_search(cache_key, q, limit))
+                SEARCH_INFLIGHT[cache_key] = task
+                task.add_done_callback(functools.partial(_search_done, cache_key))
+
+            # shield: a client disconnecting or timing out must not cancel
+            # the shared fetch
+            entry = await asyncio.wait_for(asyncio.shield(task), SEARCH_TIMEOUT)
+
+        except asyncio.TimeoutError:
+            log.error("SEARCH TIMEOUT: %r", q)
+            raise HTTPException(504, "Search timed out")
+
+        except Exception as e:
+            log.error("SEARCH ERROR: %r", e)
+            raise HTTPException(500, f"Search failed: {e!r}")
+
+    # Results for a query are stable for minutes; let browsers/CDNs revalidate
+    body, etag = entry
+    headers = {"Cache-Control": SEARCH_CACHE_CONTROL, "ETag": etag}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 
 # ---------------------------------------------------
 # HEALTH
 # ---------------------------------------------------
-@app.get("/health")
-def health():
-    return {
+def health_body():
+    return orjson.dumps({
         "status": "healthy",
         "cookies_loaded": cookie_path is not None,
         "ytmusic": ytm is not None
-    }
+    })
+
+
+HEALTH_BODY = health_body()
+
+
+@app.get("/health")
+async def health():
+    return Response(HEALTH_BODY, media_type="application/json")